@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014, Yuuki Furuyama
+# Released under the MIT License.
+
+"""Microbenchmark for decoding tabledata rows
+
+Compares per-cell BQHelper.convert_type with BQRowDecoder
+on a wide table.
+
+usage: python benchmarks/bench_decoder.py [num_columns] [num_rows]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from bqlib import BQHelper, BQRowDecoder
+
+_SAMPLE_VALUES = [
+    ('STRING', u'hello'),
+    ('INTEGER', u'1234567'),
+    ('FLOAT', u'0.123'),
+    ('BOOLEAN', u'true'),
+    ('TIMESTAMP', u'1.381190406E9'),
+]
+
+
+def make_table(num_columns, num_rows):
+    schema = []
+    values = []
+    for i in range(num_columns):
+        field_type, value = _SAMPLE_VALUES[i % len(_SAMPLE_VALUES)]
+        schema.append({'name': 'col%d' % i, 'type': field_type})
+        values.append(value)
+    row = {'f': [{'v': value} for value in values]}
+    return schema, [row] * num_rows
+
+
+def decode_with_convert_type(schema, rows):
+    results = []
+    for row in rows:
+        result = {}
+        for (field, cell) in zip(schema, row['f']):
+            result[field['name']] = BQHelper.convert_type(
+                field['type'], cell['v'])
+        results.append(result)
+    return results
+
+
+def decode_with_decoder(schema, rows):
+    return BQRowDecoder(schema).decode_rows(rows)
+
+
+def measure(func, schema, rows, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(schema, rows)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(rows) / best
+
+
+def main(argv):
+    num_columns = int(argv[1]) if len(argv) > 1 else 60
+    num_rows = int(argv[2]) if len(argv) > 2 else 20000
+    schema, rows = make_table(num_columns, num_rows)
+
+    before = measure(decode_with_convert_type, schema, rows)
+    after = measure(decode_with_decoder, schema, rows)
+    print '%d columns x %d rows' % (num_columns, num_rows)
+    print 'convert_type : %10.0f rows/sec' % before
+    print 'BQRowDecoder : %10.0f rows/sec (x%.1f)' % (after, after / before)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -11,6 +11,11 @@ import sys
 import datetime
 import os
 import re
+import json
+import hashlib
+import threading
+import weakref
+import cPickle as pickle
 
 from bigquery_client import (BigqueryError,
                              BigqueryNotFoundError,
@@ -21,6 +26,20 @@ _API = 'bigquery'
 _API_VERSION = 'v2'
 _DISCOVERY_URI = ('https://www.googleapis.com/discovery/v1/apis/'
                   '{api}/{apiVersion}/rest')
+_DEFAULT_PAGE_SIZE = 10000
+_DEFAULT_NUM_WORKERS = 4
+_MAX_CONCURRENT_QUERIES = 20
+_METADATA_TTL = 60
+_POLL_INTERVAL = 0.25
+_MAX_POLL_INTERVAL = 5
+
+# process-wide caches of discovery documents and apiclients
+_cache_lock = threading.Lock()
+_discovery_documents = {}
+_parsed_discovery_documents = {}
+_apiclients = weakref.WeakKeyDictionary()
+# process-wide cache of table information, keyed by table name
+_table_infos = {}
 
 
 class BQError(Exception):
@@ -59,7 +78,7 @@ class BaseBQ(object):
             # BigqueryClient requires 'credentials' to build
             # apiclient instance. But using 'authorized http'
             # is more versatile than using 'credentials'.
-            bq_client._apiclient = BQHelper.build_apiclient(
+            bq_client._apiclient = BQHelper.get_apiclient(
                 discovery_document,
                 http)
         self.bq_client = bq_client
@@ -71,12 +90,23 @@ class BQJob(BaseBQ):
     You can use this model to run BigQuery job.
     """
     def __init__(self, http, project_id, discovery_document_storage=None,
-                 bq_client=None, query=None, verbose=True, **kwargs):
+                 bq_client=None, query=None, verbose=True, result_cache=None,
+                 poll_interval=_POLL_INTERVAL,
+                 max_poll_interval=_MAX_POLL_INTERVAL,
+                 long_poll_timeout=None, **kwargs):
         """Initialize BQJob.
 
         Required keywords:
             http: oauth2-authorized HTTP object
             project_id: target project
+        Optional keywords:
+            result_cache: BQResultCache to reuse results of the same query
+            poll_interval: initial interval (sec) of polling job status,
+                           doubled after each poll up to 'max_poll_interval'
+            max_poll_interval: max interval (sec) of polling job status
+            long_poll_timeout: if given, wait for the job in
+                               jobs.getQueryResults up to this seconds
+                               per request instead of polling jobs.get
         """
         super(BQJob, self).__init__(
             http,
@@ -85,18 +115,31 @@ class BQJob(BaseBQ):
             bq_client=bq_client
             )
 
+        self.project_id = project_id
         self.verbose = verbose
         self.query = query
+        self.result_cache = result_cache
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.long_poll_timeout = long_poll_timeout
         self.job_reference = None
+        self.timings = {}
+        self._job = None
+        self._submitted_at = None
 
-    def run_sync(self, timeout=sys.maxint, **kwargs):
+    def run_sync(self, timeout=sys.maxint, format='rows', **kwargs):
+        if format == 'rows':
+            result = self._get_cached_result()
+            if result is not None:
+                return result
         self.run_async(**kwargs)
         try:
-            return self.get_result(timeout=timeout)
+            return self._wait_result(timeout=timeout, format=format)
         except StopIteration:
             raise BQError(message='timeout', error=[])
 
     def run_async(self, **kwargs):
+        start = _now()
         try:
             job = run_func_with_backoff(
                 self.bq_client.Query, self.query,
@@ -110,18 +153,112 @@ class BQJob(BaseBQ):
                 error = err.error
             raise BQError(message=message, error=error)
         self.job_reference = self.bq_client.ConstructObjectReference(job)
+        self._job = None
+        self._submitted_at = _now()
+        self.timings = {'submit': self._submitted_at - start, 'polls': 0}
 
-    def get_result(self, timeout=sys.maxint):
+    def get_result(self, timeout=sys.maxint, stream=False, format='rows'):
         """ get response from BigQuery
 
         same signature with async urlfetch : rpc.get_result()
+        If 'stream' is True, return a generator which fetches
+        result pages lazily instead of a list of all rows.
+        If 'format' is 'columnar', return a dict of NumPy arrays
+        (see BQTable.read_columns).
+        """
+        if format == 'rows' and not stream:
+            result = self._get_cached_result()
+            if result is not None:
+                return result
+        return self._wait_result(timeout=timeout, stream=stream, format=format)
+
+    def _wait_result(self, timeout=sys.maxint, stream=False, format='rows'):
+        if format not in ('rows', 'columnar'):
+            raise ValueError('unsupported format: %s' % format)
+        job = self.wait(timeout=timeout)
+        return self.read_result(job, stream=stream, format=format)
+
+    def wait(self, timeout=sys.maxint):
+        """wait until the job is done and return the job dict
+
+        Job status is polled at once, and then after 'poll_interval'
+        seconds with doubled intervals up to 'max_poll_interval' seconds.
+        If 'long_poll_timeout' is set, jobs.getQueryResults waits for
+        the job on the server side instead.
+        Raise StopIteration on timeout like BigqueryClient.WaitJob.
+        """
+        if self._job is not None:
+            return self._job
+        deadline = _now() + timeout
+        interval = self.poll_interval
+        while True:
+            if self.long_poll_timeout is None:
+                job = self.poll()
+            elif self._wait_query_results(
+                    max(0, min(self.long_poll_timeout, deadline - _now()))):
+                job = self.poll()
+            else:
+                job = None
+            if job is not None:
+                return job
+            remaining = deadline - _now()
+            if remaining <= 0:
+                raise StopIteration('Wait timed out after %s seconds'
+                                    % timeout)
+            if self.long_poll_timeout is None:
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, self.max_poll_interval)
+
+    def _wait_query_results(self, timeout):
+        """wait for the job in jobs.getQueryResults up to 'timeout' seconds
+
+        Return whether the job is complete.
+        """
+        params = dict(self.job_reference)
+        params['timeoutMs'] = int(timeout * 1000)
+        params['maxResults'] = 0
+        self.timings['polls'] = self.timings.get('polls', 0) + 1
+        result = self.bq_client.apiclient.jobs().getQueryResults(
+            **params).execute()
+        return result.get('jobComplete', False)
+
+    def poll(self):
+        """get job status without waiting
+
+        Return the job dict if the job is done, otherwise None.
+        """
+        job = self.bq_client.GetObjectInfo(self.job_reference)
+        self.timings['polls'] = self.timings.get('polls', 0) + 1
+        if job['status'].get('state') != 'DONE':
+            return None
+        self._job = job
+        self._set_job_timings(job)
+        return job
+
+    def _set_job_timings(self, job):
+        if self._submitted_at is not None:
+            self.timings['wait'] = _now() - self._submitted_at
+        statistics = job.get('statistics', {})
+        if 'creationTime' in statistics and 'startTime' in statistics:
+            self.timings['queue'] = (int(statistics['startTime']) -
+                                     int(statistics['creationTime'])) / 1000.0
+        if 'startTime' in statistics and 'endTime' in statistics:
+            self.timings['run'] = (int(statistics['endTime']) -
+                                   int(statistics['startTime'])) / 1000.0
+
+    def done(self):
+        """whether the job is done, without waiting
+
+        This makes one jobs.get request at most. Once it returns True,
+        get_result() reads the result without waiting for the job.
+        """
+        return self._job is not None or self.poll() is not None
+
+    def read_result(self, job, stream=False, format='rows'):
+        """read result of a job which is done
+
+        'job' is the job dict returned by poll().
         """
-        bq_client = self.bq_client
-        job_reference = self.job_reference
-        job = bq_client.WaitJob(
-            job_reference,
-            wait=timeout,
-            wait_printer_factory=bq_client.wait_printer_factory)
         if job['status'].get('errorResult') is not None:
             raise BQError(
                 message=job['status']['errorResult']['message'],
@@ -129,12 +266,34 @@ class BQJob(BaseBQ):
                 )
         if self.verbose:
             self._print_verbose(job)
+        # reuse the schema in the job instead of fetching it again
+        schema = job.get('statistics', {}).get('query', {}).get('schema')
+        if schema is not None:
+            schema = schema.get('fields', [])
         bqtable = BQTable(
             self.http,
-            bq_client=bq_client,
-            table_dict=job['configuration']['query']['destinationTable']
+            bq_client=self.bq_client,
+            table_dict=job['configuration']['query']['destinationTable'],
+            schema=schema
             )
-        return bqtable.read_rows()
+        if format == 'columnar':
+            start = _now()
+            result = bqtable.read_columns()
+            self.timings['fetch'] = _now() - start
+            return result
+        if stream:
+            return bqtable.iter_rows()
+        start = _now()
+        result = bqtable.read_rows()
+        self.timings['fetch'] = _now() - start
+        if self.result_cache is not None:
+            self.result_cache.set(self.project_id, self.query, result)
+        return result
+
+    def _get_cached_result(self):
+        if self.result_cache is None:
+            return None
+        return self.result_cache.get(self.project_id, self.query)
 
     def _print_verbose(self, job_dict):
         log_format = u"""
@@ -162,13 +321,22 @@ class BQJobGroup(object):
     into an one group.
     'run_sync' and 'ryn_async' method are executed concurrently.
     """
-    def __init__(self, jobs=[]):
+    def __init__(self, jobs=[], max_concurrency=_MAX_CONCURRENT_QUERIES,
+                 poll_interval=_POLL_INTERVAL,
+                 max_poll_interval=_MAX_POLL_INTERVAL):
         """Initialize BQJobGroup.
 
         Required keywords:
             None
+        Optional keywords:
+            max_concurrency: max number of jobs running at the same time
+            poll_interval: initial interval (sec) of polling job statuses
+            max_poll_interval: max interval (sec) of polling job statuses
         """
         self.jobs = jobs
+        self.max_concurrency = max_concurrency
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
 
     def add(self, bqjob):
         self.jobs.append(bqjob)
@@ -181,34 +349,99 @@ class BQJobGroup(object):
         return self.jobs
 
     def run_sync(self, timeout=sys.maxint):
-        # start job
-        self.run_async()
-
-        # get job result
-        results = []
-        for job in self.jobs:
-            results.append(job.get_result(timeout=timeout))
-        return results
+        return self.get_results(timeout=timeout)
 
     def run_async(self):
         for job in self.jobs:
             job.run_async()
 
-    def get_results(self):
-        results = []
+    def get_results(self, timeout=sys.maxint):
+        results = {}
+        for (job, result) in self.as_completed(timeout=timeout):
+            results[id(job)] = result
+        return [results[id(job)] for job in self.jobs]
+
+    def as_completed(self, timeout=sys.maxint):
+        """iterate (job, result) in order of completion
+
+        Jobs which are not started yet are started so that at most
+        'max_concurrency' jobs are running at the same time.
+        Statuses of all running jobs are polled together, and result of
+        each job is read on a worker thread as soon as the job is done.
+        """
+        from multiprocessing.pool import ThreadPool
+        import Queue
+
+        deadline = time.time() + timeout
+        jobs = []
         for job in self.jobs:
-            results.append(job.get_result())
-        return results
+            if job not in jobs:
+                jobs.append(job)
+        waiting = [job for job in jobs if job.job_reference is None]
+        running = [job for job in jobs if job.job_reference is not None]
+        num_fetching = 0
+        done_queue = Queue.Queue()
+        pool = ThreadPool(max(1, min(self.max_concurrency, len(jobs))))
+        interval = self.poll_interval
+        try:
+            while waiting or running or num_fetching:
+                while waiting and (len(running) + num_fetching <
+                                   self.max_concurrency):
+                    job = waiting.pop(0)
+                    job.run_async()
+                    running.append(job)
+
+                for job in running[:]:
+                    job_dict = job.poll()
+                    if job_dict is not None:
+                        running.remove(job)
+                        num_fetching += 1
+                        pool.apply_async(
+                            _call_with_exc_info,
+                            (job, job.read_result, job_dict),
+                            callback=done_queue.put)
+
+                wait = interval
+                if not running:
+                    wait = deadline - time.time()
+                if time.time() + wait > deadline:
+                    wait = deadline - time.time()
+                if wait <= 0:
+                    raise BQError(message='timeout', error=[])
+                try:
+                    (job, result, exc_info) = done_queue.get(timeout=wait)
+                except Queue.Empty:
+                    interval = min(interval * 2, self.max_poll_interval)
+                    continue
+                interval = self.poll_interval
+                while True:
+                    num_fetching -= 1
+                    if exc_info is not None:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    yield (job, result)
+                    try:
+                        (job, result, exc_info) = done_queue.get_nowait()
+                    except Queue.Empty:
+                        break
+        finally:
+            pool.close()
 
 
 class BQTable(BaseBQ):
     def __init__(self, http, project_id=None, dataset_id=None, table_id=None,
                  table_dict=None, discovery_document_storage=None,
-                 bq_client=None, **kwargs):
+                 bq_client=None, page_size=_DEFAULT_PAGE_SIZE,
+                 num_workers=_DEFAULT_NUM_WORKERS, schema=None,
+                 metadata_ttl=_METADATA_TTL, **kwargs):
         """Initialize BQTable.
 
         Required keywords:
             http: oauth2-authorized HTTP object
+        Optional keywords:
+            page_size: max rows per tabledata.list request
+            num_workers: number of threads for parallel reads
+            schema: list of fields if already known (e.g. from a job)
+            metadata_ttl: seconds to cache table information in process
         """
         super(BQTable, self).__init__(
             http,
@@ -222,33 +455,245 @@ class BQTable(BaseBQ):
                 'tableId': table_id
                 }
         self.table_dict = table_dict
+        self.page_size = page_size
+        self.num_workers = num_workers
+        self.schema = schema
+        self.metadata_ttl = metadata_ttl
 
-    def get_info(self):
-        """get table information"""
+    def get_info(self, refresh=False):
+        """get table information
+
+        Table information is cached in process for 'metadata_ttl' seconds,
+        then fetched again and checked by 'etag' and 'lastModifiedTime'.
+        If 'refresh' is True, always fetch table information.
+        """
         fqtn = BQHelper.build_fully_qualified_table_name(
             table_dict=self.table_dict,
             with_bracket=False)
+        with _cache_lock:
+            cached = _table_infos.get(fqtn)
+        if (not refresh and cached is not None and
+                cached[1] + self.metadata_ttl > _now()):
+            return cached[0]
+
         table_reference = self.bq_client.GetTableReference(fqtn)
-        return self.bq_client.GetObjectInfo(table_reference)
+        info = self.bq_client.GetObjectInfo(table_reference)
+        if cached is not None and not _is_same_table_version(cached[0], info):
+            logging.info('table %s has been modified' % fqtn)
+        with _cache_lock:
+            _table_infos[fqtn] = (info, _now())
+        return info
 
     def get_schema(self):
-        return self.bq_client.GetTableSchema(self.table_dict).get('fields', [])
+        """get list of fields
 
-    def read_rows(self):
+        The schema given to constructor or in the cached table
+        information is used if possible.
+        """
+        if self.schema is not None:
+            return self.schema
+        return self.get_info().get('schema', {}).get('fields', [])
+
+    def read_rows(self, parallel=False, ordered=True):
         """read rows from table
+
+        See iter_rows about 'parallel' and 'ordered'.
         """
-        schema = self.get_schema()
-        table_dict = self.table_dict.copy()
-        rows = self.bq_client.ReadTableRows(
-            table_dict
-            )
-        results = []
-        for row in rows:
-            result = {}
-            for (field, value) in zip(schema, row):
-                converted_value = BQHelper.convert_type(field['type'], value)
-                result[field['name']] = converted_value
-            results.append(result)
+        return list(self.iter_rows(parallel=parallel, ordered=ordered))
+
+    def iter_rows(self, parallel=False, ordered=True):
+        """iterate rows of table
+
+        Rows are fetched page by page, so memory usage depends on
+        'page_size', not on the number of rows in the table.
+        If 'parallel' is True, pages are fetched by 'num_workers' threads
+        (see iter_pages_parallel). Rows are yielded in table order
+        unless 'ordered' is False.
+        """
+        if parallel:
+            decoder = BQRowDecoder(self.get_schema())
+            pages = self.iter_pages_parallel(ordered=ordered)
+        else:
+            decoder = BQRowDecoder(self.get_schema())
+            pages = self.iter_pages()
+        for page in pages:
+            for result in decoder.decode_rows(page):
+                yield result
+
+    def read_columns(self):
+        """read rows from table into per-field NumPy arrays
+
+        Return a dict of field name to numpy.ma.MaskedArray
+        whose mask marks NULL values. Requires NumPy.
+        """
+        decoder = BQColumnDecoder(self.get_schema())
+        return decoder.concatenate(
+            [decoder.decode_rows(page) for page in self.iter_pages()])
+
+    def iter_pages(self, start_index=0, max_rows=None):
+        """iterate raw tabledata pages
+
+        Each page is a list of rows in tabledata format ({'f': [{'v': ..}]}).
+        The first page is requested by 'startIndex' and subsequent
+        pages follow 'pageToken'.
+        """
+        page_token = None
+        num_rows = 0
+        while max_rows is None or num_rows < max_rows:
+            max_results = self.page_size
+            if max_rows is not None:
+                max_results = min(max_results, max_rows - num_rows)
+            data = self._list_tabledata(
+                max_results, start_index=start_index, page_token=page_token)
+            rows = data.get('rows', [])
+            if not rows:
+                break
+            num_rows += len(rows)
+            yield rows
+            page_token = data.get('pageToken')
+            if page_token is None:
+                break
+
+    def iter_pages_parallel(self, num_rows=None, ordered=True):
+        """iterate raw tabledata pages fetched by multiple threads
+
+        The table is split into 'startIndex'/'maxResults' ranges of
+        'page_size' rows and the ranges are fetched by 'num_workers'
+        threads. At most 2 * 'num_workers' pages are buffered.
+        If 'ordered' is False, pages are yielded as soon as fetched.
+        'num_rows' is taken from get_info() if not given.
+        The http object must be safe to use from multiple threads.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        if num_rows is None:
+            num_rows = int(self.get_info().get('numRows', 0))
+        ranges = [(start, min(self.page_size, num_rows - start))
+                  for start in xrange(0, num_rows, self.page_size)]
+        if not ranges:
+            return
+        pool = ThreadPool(max(1, min(self.num_workers, len(ranges))))
+        try:
+            for page in _imap_bounded(pool, self._read_range, ranges,
+                                      2 * self.num_workers, ordered):
+                yield page
+        finally:
+            pool.close()
+
+    def _read_range(self, start_index, num_rows):
+        # a response may be cut short by the size limit of tabledata.list,
+        # so continue until the whole range is read
+        rows = []
+        while len(rows) < num_rows:
+            data = self._list_tabledata(
+                num_rows - len(rows), start_index=start_index + len(rows))
+            more_rows = data.get('rows', [])
+            if not more_rows:
+                break
+            rows.extend(more_rows)
+        return rows
+
+    def _list_tabledata(self, max_results, start_index=None, page_token=None):
+        params = {
+            'projectId': self.table_dict['projectId'],
+            'datasetId': self.table_dict['datasetId'],
+            'tableId': self.table_dict['tableId'],
+            'maxResults': max_results,
+            }
+        if page_token is not None:
+            params['pageToken'] = page_token
+        elif start_index:
+            params['startIndex'] = start_index
+        return self.bq_client.apiclient.tabledata().list(**params).execute()
+
+
+class BQRowDecoder(object):
+    """Row decoder compiled from a table schema
+
+    Each field is mapped to its converter once, so decoding
+    doesn't interpret the schema for every cell.
+    """
+    def __init__(self, schema):
+        """Initialize BQRowDecoder.
+
+        Required keywords:
+            schema: list of fields returned by BQTable.get_schema()
+        """
+        self.schema = schema
+        self.names = [field['name'] for field in schema]
+        self.converters = [BQRowDecoder.get_converter(field['type'])
+                           for field in schema]
+
+    @staticmethod
+    def get_converter(field_type):
+        """get a function which converts a cell value to 'field_type'"""
+        try:
+            return _CONVERTERS[field_type.upper()]
+        except KeyError:
+            raise ValueError('unsupported field type: %s' % field_type)
+
+    def decode_row(self, row):
+        """decode a row in tabledata format ({'f': [{'v': ..}]})"""
+        return self.decode_rows([row])[0]
+
+    def decode_rows(self, rows):
+        """decode a list of rows in tabledata format"""
+        names = self.names
+        converters = self.converters
+        return [
+            dict(zip(names, [
+                None if value is None else convert(value)
+                for (convert, value)
+                in zip(converters, [cell['v'] for cell in row['f']])]))
+            for row in rows]
+
+
+class BQColumnDecoder(object):
+    """Columnar decoder compiled from a table schema
+
+    Decode tabledata rows into per-field NumPy arrays:
+        STRING    -> object
+        INTEGER   -> int64
+        FLOAT     -> float64
+        BOOLEAN   -> bool
+        TIMESTAMP -> datetime64[us]
+    NULL values are marked by the mask of numpy.ma.MaskedArray.
+    """
+    def __init__(self, schema):
+        """Initialize BQColumnDecoder.
+
+        Required keywords:
+            schema: list of fields returned by BQTable.get_schema()
+        """
+        self.schema = schema
+        self.names = [field['name'] for field in schema]
+        self.field_types = [field['type'].upper() for field in schema]
+        for field_type in self.field_types:
+            if field_type not in _NUMPY_DTYPES:
+                raise ValueError('unsupported field type: %s' % field_type)
+
+    def decode_rows(self, rows):
+        """decode a list of rows in tabledata format into arrays"""
+        values = [[cell['v'] for cell in row['f']] for row in rows]
+        if values:
+            columns = zip(*values)
+        else:
+            columns = [()] * len(self.names)
+        results = {}
+        for (name, field_type, column) in zip(
+                self.names, self.field_types, columns):
+            results[name] = _to_masked_array(field_type, column)
+        return results
+
+    def concatenate(self, pages):
+        """concatenate arrays decoded from each page"""
+        import numpy
+        if not pages:
+            pages = [self.decode_rows([])]
+        results = {}
+        for name in self.names:
+            results[name] = numpy.ma.concatenate(
+                [page[name] for page in pages])
         return results
 
 
@@ -274,14 +719,21 @@ class BQHelper(object):
     def retrieve_discovery_document(storage=None):
         u""" Retrieve discovery document for BigQuery
 
-        At first, discovery document is to be fetched from memcache.
+        At first, discovery document is to be fetched from the process-wide
+        cache, and then from memcache.
         If discovery document doesn't exist in memcache,
         publish HTTP request to get a document discovery and set it to memcache
         """
+        cache_key = (_API, _API_VERSION)
+        discovery_document = _discovery_documents.get(cache_key)
+        if discovery_document is not None:
+            return discovery_document
+
+        document_key = 'discovery_document'
         if storage is not None and hasattr(storage, 'get'):
-            document_key = 'discovery_document'
             discovery_document = storage.get(document_key)
             if discovery_document is not None:
+                _discovery_documents[cache_key] = discovery_document
                 return discovery_document
 
         params = {'api': _API, 'apiVersion': _API_VERSION}
@@ -297,6 +749,7 @@ class BQHelper(object):
         if storage is not None and hasattr(storage, 'set'):
             storage.set(document_key, body, time=86400)  # 86400 = 1 day
 
+        _discovery_documents[cache_key] = body
         return body
 
     @staticmethod
@@ -310,6 +763,42 @@ class BQHelper(object):
             model=bigquery_model,
             requestBuilder=BigqueryHttp.Factory(bigquery_model))
 
+    @staticmethod
+    def get_apiclient(discovery_document, http):
+        """Get apiclient from the process-wide cache or build it
+
+        Apiclients are cached per http object and API version,
+        and the discovery document is parsed only once per process.
+        """
+        with _cache_lock:
+            try:
+                apiclients = _apiclients.setdefault(http, {})
+            except TypeError:
+                # http object which can't be weakly referenced
+                apiclients = {}
+            apiclient = apiclients.get(_API_VERSION)
+            if apiclient is None:
+                cache_key = (_API, _API_VERSION)
+                if cache_key not in _parsed_discovery_documents:
+                    _parsed_discovery_documents[cache_key] = json.loads(
+                        discovery_document)
+                apiclient = BQHelper.build_apiclient(
+                    _parsed_discovery_documents[cache_key], http)
+                apiclients[_API_VERSION] = apiclient
+            return apiclient
+
+    @staticmethod
+    def clear_cache():
+        """Clear the process-wide caches
+
+        discovery documents, apiclients and table information are cleared.
+        """
+        with _cache_lock:
+            _discovery_documents.clear()
+            _parsed_discovery_documents.clear()
+            _apiclients.clear()
+            _table_infos.clear()
+
     @staticmethod
     def convert_type(field_type, value):
         """convert type of 'value' to 'field_type'
@@ -368,9 +857,298 @@ class BQHelper(object):
             return "%s:%s.%s" % (project_id, dataset_id, table_id)
 
 
+class BQFileStorage(object):
+    """File-based storage with expiration
+
+    It has the same get/set interface as memcache, so it can be
+    used as 'discovery_document_storage' outside App Engine.
+    """
+    def __init__(self, directory):
+        """Initialize BQFileStorage.
+
+        Required keywords:
+            directory: directory to store files in
+        """
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                (expires, value) = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if expires and expires < _now():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, time=0):
+        """set 'value' which expires after 'time' seconds (0: never)"""
+        expires = 0
+        if time:
+            expires = _now() + time
+        path = self._path(key)
+        tmp_path = '%s.%d.%d' % (
+            path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        return True
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+
+class BQResultCache(object):
+    """Cache for query results
+
+    Results are keyed by project and query text with whitespace
+    normalized. The memory tier evicts the least recently used
+    results and expires them after 'ttl' seconds. If 'storage' (e.g.
+    BQFileStorage or memcache) is given, it is used as the second tier.
+    Results are shared between callers, so don't modify them.
+    """
+    def __init__(self, max_entries=128, max_rows=None, max_bytes=None,
+                 ttl=300, storage=None):
+        """Initialize BQResultCache.
+
+        Optional keywords:
+            max_entries: max number of results in memory
+            max_rows: max total number of rows in memory
+            max_bytes: max total bytes (pickled size) in memory
+            ttl: seconds until a cached result expires
+            storage: object with memcache-like get/set for the second tier
+        """
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.storage = storage
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.num_rows = 0
+        self.num_bytes = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        # circular doubly linked list of entries, most recently used first
+        # entry: [prev, next, key, result, expires, num_rows, num_bytes]
+        self._root = [None, None, None, None, None, 0, 0]
+        self._root[0] = self._root[1] = self._root
+
+    @staticmethod
+    def make_key(project_id, query):
+        """make a cache key from project and normalized query text"""
+        query = u' '.join(query.split())
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        return 'bqlib_result:%s' % hashlib.sha1(
+            '%s\n%s' % (project_id, query)).hexdigest()
+
+    def get(self, project_id, query):
+        """get a cached result, or None"""
+        key = self.make_key(project_id, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[4] < _now():
+                self._remove(entry)
+                entry = None
+            if entry is not None:
+                self._unlink(entry)
+                self._link(entry)
+                self.hits += 1
+                return entry[3]
+
+        result = None
+        if self.storage is not None:
+            result = self.storage.get(key)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._put(key, result, _now() + self.ttl)
+        return result
+
+    def set(self, project_id, query, result):
+        """cache a result (list of rows)"""
+        key = self.make_key(project_id, query)
+        if self.storage is not None:
+            self.storage.set(key, result, time=self.ttl)
+        with self._lock:
+            self._put(key, result, _now() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            while self._root[1] is not self._root:
+                self._remove(self._root[1])
+
+    def get_stats(self):
+        """get hit/miss counters and sizes"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'rows': self.num_rows,
+                'bytes': self.num_bytes,
+                }
+
+    def _put(self, key, result, expires):
+        num_bytes = 0
+        if self.max_bytes is not None:
+            num_bytes = len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        if ((self.max_rows is not None and len(result) > self.max_rows) or
+                (self.max_bytes is not None and num_bytes > self.max_bytes)):
+            return
+        if key in self._entries:
+            self._remove(self._entries[key])
+        entry = [None, None, key, result, expires, len(result), num_bytes]
+        self._link(entry)
+        self._entries[key] = entry
+        self.num_rows += entry[5]
+        self.num_bytes += entry[6]
+        while (len(self._entries) > self.max_entries or
+               (self.max_rows is not None and
+                self.num_rows > self.max_rows) or
+               (self.max_bytes is not None and
+                self.num_bytes > self.max_bytes)):
+            self._remove(self._root[0])
+            self.evictions += 1
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry[2]]
+        self.num_rows -= entry[5]
+        self.num_bytes -= entry[6]
+
+    def _link(self, entry):
+        root = self._root
+        entry[0] = root
+        entry[1] = root[1]
+        root[1][0] = entry
+        root[1] = entry
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+
 """utility functions"""
 
 
+def _now():
+    return time.time()
+
+
+def _to_string(value):
+    return value
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return value.lower() == 'true'
+
+
+def _to_datetime(value):
+    return datetime.datetime.utcfromtimestamp(float(value))
+
+
+def _to_masked_array(field_type, values):
+    import numpy
+    mask = numpy.array([value is None for value in values], dtype=bool)
+    if field_type == 'STRING':
+        data = numpy.array(values, dtype=object)
+    else:
+        filled = numpy.array(
+            [u'0' if value is None else value for value in values],
+            dtype=unicode)
+        if field_type == 'INTEGER':
+            data = filled.astype(numpy.int64)
+        elif field_type == 'FLOAT':
+            data = filled.astype(numpy.float64)
+        elif field_type == 'BOOLEAN':
+            data = numpy.char.lower(filled) == u'true'
+        elif field_type == 'TIMESTAMP':
+            data = numpy.round(filled.astype(numpy.float64) * 1e6)
+            data = data.astype(numpy.int64).view('datetime64[us]')
+    if not len(values):
+        data = data.astype(_NUMPY_DTYPES[field_type])
+    return numpy.ma.MaskedArray(data, mask=mask)
+
+
+_NUMPY_DTYPES = {
+    'STRING': 'object',
+    'INTEGER': 'int64',
+    'FLOAT': 'float64',
+    'BOOLEAN': 'bool',
+    'TIMESTAMP': 'datetime64[us]',
+    }
+
+_CONVERTERS = {
+    'STRING': _to_string,
+    'INTEGER': int,
+    'FLOAT': float,
+    'BOOLEAN': _to_bool,
+    'TIMESTAMP': _to_datetime,
+    }
+
+
+def _is_same_table_version(info1, info2):
+    return (info1.get('etag') == info2.get('etag') and
+            info1.get('lastModifiedTime') == info2.get('lastModifiedTime'))
+
+
+def _call_with_exc_info(key, func, *args):
+    """call 'func' and return (key, result, exc_info) instead of raising"""
+    try:
+        return (key, func(*args), None)
+    except Exception:
+        return (key, None, sys.exc_info())
+
+
+def _imap_bounded(pool, func, args_list, window, ordered=True):
+    """like pool.imap but keep at most 'window' tasks not yet consumed"""
+    import Queue
+    from collections import deque
+
+    args_list = deque(args_list)
+    window = max(1, window)
+    if ordered:
+        pending = deque()
+        while args_list or pending:
+            while args_list and len(pending) < window:
+                pending.append(pool.apply_async(func, args_list.popleft()))
+            yield pending.popleft().get()
+    else:
+        done_queue = Queue.Queue()
+        num_pending = 0
+        while args_list or num_pending:
+            while args_list and num_pending < window:
+                args = args_list.popleft()
+                pool.apply_async(_call_with_exc_info, (None, func) + args,
+                                 callback=done_queue.put)
+                num_pending += 1
+            (_, result, exc_info) = done_queue.get()
+            num_pending -= 1
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield result
+
+
 def is_str_or_unicode(obj):
     return isinstance(obj, unicode) or isinstance(obj, str)
 
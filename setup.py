@@ -19,4 +19,7 @@ setup(
     install_requires=[
         'bigquery>=2.0.17',
         ],
+    extras_require={
+        'numpy': ['numpy'],
+        },
     )
@@ -6,12 +6,15 @@
 
 import os
 import sys
+import datetime
 from inspect import isclass
 from contextlib import nested
 
 import pytest
 from mock import patch, Mock
-from bqlib import BQJob, BQJobGroup, BQTable, BQHelper, BQError
+from bqlib import (BQJob, BQJobGroup, BQTable, BQHelper, BQError,
+                   BQRowDecoder, BQColumnDecoder, BQFileStorage,
+                   BQResultCache)
 
 ### fixtures
 _fixtures_convert_type = [
@@ -45,10 +48,89 @@ _fixtures_query_results = [
 ]
 
 
+_fixtures_row_decoder = [
+    ([{'name': 'name', 'type': 'STRING'},
+      {'name': 'count', 'type': 'INTEGER'},
+      {'name': 'ratio', 'type': 'FLOAT'},
+      {'name': 'flag', 'type': 'boolean'},
+      {'name': 'time', 'type': 'TIMESTAMP'}],
+     [{'f': [{'v': u'foo'}, {'v': u'10'}, {'v': u'0.5'}, {'v': u'true'},
+             {'v': u'1.3811904E9'}]},
+      {'f': [{'v': None}, {'v': None}, {'v': None}, {'v': u'false'},
+             {'v': None}]}],
+     [{'name': u'foo', 'count': 10, 'ratio': 0.5, 'flag': True,
+       'time': datetime.datetime(2013, 10, 8, 0, 0)},
+      {'name': None, 'count': None, 'ratio': None, 'flag': False,
+       'time': None}],
+     ),
+]
+
+
+class TabledataMock(object):
+    """Mock for tabledata collection of apiclient"""
+    def __init__(self, bq_client):
+        self._bq_client = bq_client
+        self.list_calls = []
+
+    def list(self, projectId, datasetId, tableId, maxResults=None,
+             pageToken=None, startIndex=None):
+        self.list_calls.append({'pageToken': pageToken,
+                                'startIndex': startIndex,
+                                'maxResults': maxResults})
+        rows = self._bq_client._rows
+        start = int(pageToken or startIndex or 0)
+        end = len(rows)
+        if maxResults is not None:
+            end = min(end, start + maxResults)
+        data = {
+            'totalRows': str(len(rows)),
+            'rows': [{'f': [{'v': v} for v in row]} for row in rows[start:end]],
+        }
+        if end < len(rows):
+            data['pageToken'] = str(end)
+        result = Mock()
+        result.execute.return_value = data
+        return result
+
+
+class JobsMock(object):
+    """Mock for jobs collection of apiclient"""
+    def __init__(self):
+        self.job_complete = True
+        self.get_query_results_calls = []
+
+    def getQueryResults(self, projectId, jobId, timeoutMs=None,
+                        maxResults=None, pageToken=None, startIndex=None):
+        self.get_query_results_calls.append({'timeoutMs': timeoutMs})
+        result = Mock()
+        result.execute.return_value = {'jobComplete': self.job_complete}
+        return result
+
+
+class ApiclientMock(object):
+    """Mock for apiclient built from discovery document"""
+    def __init__(self, bq_client):
+        self._tabledata = TabledataMock(bq_client)
+        self._jobs = JobsMock()
+
+    def tabledata(self):
+        return self._tabledata
+
+    def jobs(self):
+        return self._jobs
+
+
+class TableReferenceMock(object):
+    """Mock for TableReference class"""
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+
 class BigqueryClientMock(object):
     """Mock for BigqueryClient class"""
     def __init__(self):
         self.wait_printer_factory = Mock()
+        self.apiclient = ApiclientMock(self)
     def setup_schema_and_rows(self, schema, rows):
         self._schema = {
             'fields': schema
@@ -58,18 +140,31 @@ class BigqueryClientMock(object):
         job = Mock()
         return job
     def ConstructObjectReference(self, job):
-        return Mock()
+        return {'projectId': 'test_project', 'jobId': 'test_job'}
     def WaitJob(self, job_reference, status='DONE',
               wait=sys.maxint, wait_printer_factory=None):
+        return self.GetObjectInfo(job_reference)
+    def GetTableReference(self, identifier):
+        return TableReferenceMock(identifier)
+    def GetObjectInfo(self, reference):
+        if isinstance(reference, TableReferenceMock):
+            return {
+                'numRows': str(len(self._rows)),
+                'schema': self._schema,
+            }
         job_fixture = {
           "kind": "bigquery#job",
           "configuration": {
             "query": {
               "destinationTable": {
+                "projectId": "test_project",
+                "datasetId": "test_dataset",
+                "tableId": "test_table",
               },
             },
           },
           "status": {
+            "state": "DONE",
           }
         }
         job = job_fixture
@@ -119,7 +214,7 @@ def pytest_funcarg__bqtable(request):
 class TestBQJob(object):
     """test for BQJob class"""
     def setup_method(self, method):
-        pass
+        BQHelper.clear_cache()
 
     def teardown_method(self, method):
         pass
@@ -138,6 +233,89 @@ class TestBQJob(object):
         bqjob.bq_client.setup_schema_and_rows(schema, rows)
         assert bqjob.get_result() == expected
 
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
+    def test_done(self, bqjob, schema, rows, expected):
+        bqjob.bq_client.setup_schema_and_rows(schema, rows)
+        bqjob.run_async()
+        done = bqjob.bq_client.GetObjectInfo(None)
+        running = {'status': {'state': 'RUNNING'}}
+        with patch.object(bqjob.bq_client, 'GetObjectInfo',
+                          side_effect=[running, done]) as get_object_info:
+            assert not bqjob.done()
+            assert bqjob.done()
+            assert bqjob.done()
+            assert get_object_info.call_count == 2
+        with patch.object(bqjob.bq_client, 'WaitJob') as wait_job:
+            assert bqjob.get_result() == expected
+            assert not wait_job.called
+
+    def test_wait(self, bqjob):
+        bqjob.run_async()
+        done = bqjob.bq_client.GetObjectInfo(None)
+        done['statistics'] = {'creationTime': '1000', 'startTime': '1500',
+                              'endTime': '4000'}
+        running = {'status': {'state': 'RUNNING'}}
+        bqjob.poll_interval = 0.5
+        bqjob.max_poll_interval = 1.5
+        with nested(
+                patch.object(bqjob.bq_client, 'GetObjectInfo',
+                             side_effect=[running] * 4 + [done]),
+                patch('time.sleep')
+                ) as (get_object_info, sleep):
+            assert bqjob.wait() == done
+            assert [c[0][0] for c in sleep.call_args_list] == [0.5, 1.0, 1.5, 1.5]
+        assert bqjob.timings['polls'] == 5
+        assert bqjob.timings['queue'] == 0.5
+        assert bqjob.timings['run'] == 2.5
+        assert 'submit' in bqjob.timings and 'wait' in bqjob.timings
+
+    def test_wait_timeout(self, bqjob):
+        bqjob.run_async()
+        running = {'status': {'state': 'RUNNING'}}
+        bqjob.poll_interval = 0.01
+        with patch.object(bqjob.bq_client, 'GetObjectInfo', return_value=running):
+            with pytest.raises(StopIteration):
+                bqjob.wait(timeout=0.05)
+            with pytest.raises(BQError):
+                bqjob.run_sync(timeout=0.05)
+
+    def test_wait_long_poll(self, bqjob):
+        bqjob.run_async()
+        bqjob.long_poll_timeout = 10
+        jobs = bqjob.bq_client.apiclient.jobs()
+        with patch('time.sleep') as sleep:
+            assert bqjob.wait() is not None
+            assert not sleep.called
+        assert jobs.get_query_results_calls == [{'timeoutMs': 10000}]
+
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
+    def test_get_result_stream(self, bqjob, schema, rows, expected):
+        bqjob.bq_client.setup_schema_and_rows(schema, rows)
+        result = bqjob.get_result(stream=True)
+        assert not isinstance(result, list)
+        assert list(result) == expected
+
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
+    def test_run_sync_with_result_cache(self, bqjob, schema, rows, expected):
+        bqjob.bq_client.setup_schema_and_rows(schema, rows)
+        bqjob.query = 'SELECT foo FROM bar'
+        bqjob.result_cache = BQResultCache()
+        with patch.object(bqjob.bq_client, 'Query',
+                          wraps=bqjob.bq_client.Query) as query:
+            assert bqjob.run_sync() == expected
+            assert bqjob.run_sync() == expected
+            assert query.call_count == 1
+        assert bqjob.result_cache.hits == 1
+        assert bqjob.result_cache.misses == 1
+
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
+    def test_get_result_with_schema_in_job(self, bqjob, schema, rows, expected):
+        bqjob.bq_client.setup_schema_and_rows([], rows)
+        job = bqjob.bq_client.GetObjectInfo(None)
+        job['statistics'] = {'query': {'schema': {'fields': schema}}}
+        bqjob.run_async()
+        assert bqjob.read_result(job) == expected
+
     @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
     def test_get_result_with_error(self, bqjob, schema, rows, expected):
         job_with_error = {
@@ -147,7 +325,7 @@ class TestBQJob(object):
                 }
             }
         }
-        with patch.object(bqjob.bq_client, 'WaitJob', return_value=job_with_error):
+        with patch.object(bqjob.bq_client, 'GetObjectInfo', return_value=job_with_error):
             with pytest.raises(BQError):
                 bqjob.bq_client.setup_schema_and_rows(schema, rows)
                 bqjob.get_result()
@@ -157,7 +335,7 @@ class TestBQJobGroup(object):
     """test for BQJobGroup class"""
 
     def setup_method(self, method):
-        pass
+        BQHelper.clear_cache()
 
     def teardown_method(self, method):
         pass
@@ -182,6 +360,39 @@ class TestBQJobGroup(object):
         expected = [results for bqjob in range(0, len(bq_jobgroup.get_jobs()))]
         assert bq_jobgroup.get_results() == expected
 
+    @pytest.mark.parametrize(('schema', 'rows', 'results'), _fixtures_query_results)
+    def test_as_completed(self, bq_jobgroup, schema, rows, results):
+        slow_job, fast_job = bq_jobgroup.get_jobs()
+        for bqjob in bq_jobgroup.get_jobs():
+            bqjob.bq_client.setup_schema_and_rows(schema, rows)
+        bq_jobgroup.poll_interval = 0.01
+        # slow_job is done at the 3rd poll, fast_job at the 1st poll
+        done = slow_job.bq_client.GetObjectInfo(None)
+        running = {'status': {'state': 'RUNNING'}}
+        with patch.object(slow_job.bq_client, 'GetObjectInfo',
+                          side_effect=[running, running, done]):
+            completed = list(bq_jobgroup.as_completed())
+        assert [job for (job, result) in completed] == [fast_job, slow_job]
+        assert [result for (job, result) in completed] == [results, results]
+
+    def test_as_completed_max_concurrency(self, bq_jobgroup):
+        bq_jobgroup.max_concurrency = 1
+        bq_jobgroup.poll_interval = 0.01
+        first_job, second_job = bq_jobgroup.get_jobs()
+        first_job.bq_client.setup_schema_and_rows([], [])
+        second_job.bq_client.setup_schema_and_rows([], [])
+        iterator = bq_jobgroup.as_completed()
+        assert next(iterator)[0] is first_job
+        assert second_job.job_reference is None
+        assert next(iterator)[0] is second_job
+
+    def test_as_completed_timeout(self, bq_jobgroup):
+        running = {'status': {'state': 'RUNNING'}}
+        for bqjob in bq_jobgroup.get_jobs():
+            bqjob.bq_client.GetObjectInfo = Mock(return_value=running)
+        with pytest.raises(BQError):
+            list(bq_jobgroup.as_completed(timeout=0.05))
+
     @pytest.mark.parametrize(('schema', 'rows', 'results'), _fixtures_query_results)
     def test_run_sync(self, bq_jobgroup, schema, rows, results):
         for bqjob in bq_jobgroup.get_jobs():
@@ -192,20 +403,123 @@ class TestBQJobGroup(object):
 
 class TestBQTable(object):
     """test for BQTable class"""
+    def setup_method(self, method):
+        BQHelper.clear_cache()
+
+    def test_get_info_cache(self, bqtable):
+        bqtable.bq_client.setup_schema_and_rows([], [])
+        info = {'etag': 'foo', 'lastModifiedTime': '1', 'schema': {}}
+        with patch.object(bqtable.bq_client, 'GetObjectInfo',
+                          return_value=info) as get_object_info:
+            with patch('bqlib._now', return_value=1000.0):
+                assert bqtable.get_info() == info
+                assert bqtable.get_info() == info
+                assert get_object_info.call_count == 1
+                bqtable.get_info(refresh=True)
+                assert get_object_info.call_count == 2
+            with patch('bqlib._now', return_value=1000.0 + bqtable.metadata_ttl):
+                bqtable.get_info()
+                assert get_object_info.call_count == 3
+
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
+    def test_read_rows_with_schema(self, bqtable, schema, rows, expected):
+        bqtable.bq_client.setup_schema_and_rows([], rows)
+        bqtable.schema = schema
+        with patch.object(bqtable.bq_client, 'GetObjectInfo') as get_object_info:
+            assert bqtable.read_rows() == expected
+            assert not get_object_info.called
     @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
     def test_read_rows(self, bqtable, schema, rows, expected):
         bqtable.bq_client.setup_schema_and_rows(schema, rows)
         assert bqtable.read_rows() == expected
 
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
+    def test_iter_rows(self, bqtable, schema, rows, expected):
+        bqtable.bq_client.setup_schema_and_rows(schema, rows)
+        bqtable.page_size = 2
+        list_calls = bqtable.bq_client.apiclient.tabledata().list_calls
+        iterator = bqtable.iter_rows()
+        assert next(iterator) == expected[0]
+        # only the first page has been fetched yet
+        assert len(list_calls) == 1
+        assert [expected[0]] + list(iterator) == expected
+        assert [call['pageToken'] for call in list_calls] == [None, '2']
+
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
+    def test_read_rows_parallel(self, bqtable, schema, rows, expected):
+        bqtable.bq_client.setup_schema_and_rows(schema, rows)
+        bqtable.page_size = 1
+        bqtable.num_workers = 2
+        assert bqtable.read_rows(parallel=True) == expected
+        list_calls = bqtable.bq_client.apiclient.tabledata().list_calls
+        assert sorted(call['startIndex'] or 0 for call in list_calls) == [0, 1, 2]
+
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
+    def test_read_rows_parallel_unordered(self, bqtable, schema, rows, expected):
+        bqtable.bq_client.setup_schema_and_rows(schema, rows)
+        bqtable.page_size = 2
+        results = bqtable.read_rows(parallel=True, ordered=False)
+        assert sorted(results) == sorted(expected)
+
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_query_results)
+    def test_read_columns(self, bqtable, schema, rows, expected):
+        numpy = pytest.importorskip('numpy')
+        bqtable.bq_client.setup_schema_and_rows(schema, rows)
+        bqtable.page_size = 2
+        columns = bqtable.read_columns()
+        assert sorted(columns.keys()) == sorted(f['name'] for f in schema)
+        assert columns['charge'].dtype == numpy.float64
+        assert columns['date'].dtype == object
+        for field in schema:
+            assert list(columns[field['name']]) == [
+                row[field['name']] for row in expected]
+
+
+class TestBQRowDecoder(object):
+    """test for BQRowDecoder class"""
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_row_decoder)
+    def test_decode_rows(self, schema, rows, expected):
+        decoder = BQRowDecoder(schema)
+        assert decoder.decode_rows(rows) == expected
+        assert decoder.decode_row(rows[0]) == expected[0]
+
+    def test_unsupported_type(self):
+        with pytest.raises(ValueError):
+            BQRowDecoder([{'name': 'foo', 'type': 'FOO'}])
+
+
+class TestBQColumnDecoder(object):
+    """test for BQColumnDecoder class"""
+    @pytest.mark.parametrize(('schema', 'rows', 'expected'), _fixtures_row_decoder)
+    def test_decode_rows(self, schema, rows, expected):
+        numpy = pytest.importorskip('numpy')
+        decoder = BQColumnDecoder(schema)
+        columns = decoder.concatenate(
+            [decoder.decode_rows(rows[:1]), decoder.decode_rows(rows[1:])])
+        assert columns['count'].dtype == numpy.int64
+        assert columns['flag'].dtype == numpy.bool_
+        assert columns['time'].dtype == numpy.dtype('datetime64[us]')
+        for name in decoder.names:
+            column = columns[name]
+            assert list(numpy.ma.getmaskarray(column)) == [
+                row[name] is None for row in expected]
+            assert [v for v in column.compressed().tolist()] == [
+                row[name] for row in expected if row[name] is not None]
+
+    def test_empty(self):
+        pytest.importorskip('numpy')
+        decoder = BQColumnDecoder([{'name': 'foo', 'type': 'INTEGER'}])
+        assert len(decoder.concatenate([])['foo']) == 0
+
 
 class TestBQHelper(object):
     """test for BQHelper class"""
 
     def setup_method(self, method):
-        pass
+        BQHelper.clear_cache()
 
     def teardown_method(self, method):
-        pass
+        BQHelper.clear_cache()
 
     @pytest.mark.parametrize(('runtime', 'expected'), _fixtures_is_gae_run_time)
     def test_is_gae_runtime(self, runtime, expected):
@@ -248,6 +562,29 @@ class TestBQHelper(object):
             # retrieve from storage
             assert BQHelper.retrieve_discovery_document(storage) is not None
 
+    def test_retrieve_discovery_document_cache(self):
+        class _DiscoveryHTTPResponse(object):
+            def read(self):
+                return '{}'
+
+        with patch('urllib2.urlopen',
+                   return_value=_DiscoveryHTTPResponse()) as urlopen:
+            assert BQHelper.retrieve_discovery_document() == '{}'
+            assert BQHelper.retrieve_discovery_document() == '{}'
+            assert urlopen.call_count == 1
+
+    def test_get_apiclient(self):
+        http1 = Mock()
+        http2 = Mock()
+        with patch('bqlib.BQHelper.build_apiclient',
+                   side_effect=lambda document, http: Mock()) as build:
+            apiclient1 = BQHelper.get_apiclient('{}', http1)
+            assert BQHelper.get_apiclient('{}', http1) is apiclient1
+            apiclient2 = BQHelper.get_apiclient('{}', http2)
+            assert apiclient2 is not apiclient1
+            assert build.call_count == 2
+            assert build.call_args[0][0] == {}
+
     @pytest.mark.parametrize(('project_id', 'dataset_id', 'table_id', 'expected'),
             _fixtures_build_fully_qualified_table_name)
     def test_build_fully_qualified_table_name(self, project_id, 
@@ -256,6 +593,77 @@ class TestBQHelper(object):
                 project_id, dataset_id, table_id) == expected
 
 
+class TestBQFileStorage(object):
+    """test for BQFileStorage class"""
+    def test_get_and_set(self, tmpdir):
+        storage = BQFileStorage(str(tmpdir))
+        assert storage.get('foo') is None
+        storage.set('foo', {'bar': [1, 2]})
+        assert storage.get('foo') == {'bar': [1, 2]}
+        assert BQFileStorage(str(tmpdir)).get('foo') == {'bar': [1, 2]}
+        storage.delete('foo')
+        assert storage.get('foo') is None
+
+    def test_expiration(self, tmpdir):
+        storage = BQFileStorage(str(tmpdir))
+        with patch('bqlib._now', return_value=1000.0):
+            storage.set('foo', 'bar', time=60)
+        with patch('bqlib._now', return_value=1059.0):
+            assert storage.get('foo') == 'bar'
+        with patch('bqlib._now', return_value=1061.0):
+            assert storage.get('foo') is None
+
+
+class TestBQResultCache(object):
+    """test for BQResultCache class"""
+    def test_normalized_query(self):
+        cache = BQResultCache()
+        cache.set('project', 'SELECT foo\n  FROM bar', [{'foo': 1}])
+        assert cache.get('project', ' SELECT foo FROM bar') == [{'foo': 1}]
+        assert cache.get('other_project', 'SELECT foo FROM bar') is None
+        assert cache.get_stats()['hits'] == 1
+        assert cache.get_stats()['misses'] == 1
+
+    def test_lru_eviction(self):
+        cache = BQResultCache(max_entries=2)
+        cache.set('project', 'query1', [1])
+        cache.set('project', 'query2', [2])
+        cache.get('project', 'query1')
+        cache.set('project', 'query3', [3])
+        assert cache.get('project', 'query2') is None
+        assert cache.get('project', 'query1') == [1]
+        assert cache.get('project', 'query3') == [3]
+        assert cache.evictions == 1
+
+    def test_size_limit(self):
+        cache = BQResultCache(max_rows=3, max_bytes=10000)
+        cache.set('project', 'query1', [1, 2])
+        cache.set('project', 'query2', [3, 4])
+        assert cache.get('project', 'query1') is None
+        cache.set('project', 'query3', range(4))
+        assert cache.get('project', 'query3') is None
+        assert cache.get_stats()['rows'] == 2
+        cache.set('project', 'query4', ['x' * 20000])
+        assert cache.get('project', 'query4') is None
+
+    def test_ttl(self):
+        cache = BQResultCache(ttl=60)
+        with patch('bqlib._now', return_value=1000.0):
+            cache.set('project', 'query', [1])
+        with patch('bqlib._now', return_value=1059.0):
+            assert cache.get('project', 'query') == [1]
+        with patch('bqlib._now', return_value=1061.0):
+            assert cache.get('project', 'query') is None
+        assert cache.get_stats()['entries'] == 0
+
+    def test_storage(self, tmpdir):
+        cache = BQResultCache(storage=BQFileStorage(str(tmpdir)))
+        cache.set('project', 'query', [{'foo': 1}])
+        other_cache = BQResultCache(storage=BQFileStorage(str(tmpdir)))
+        assert other_cache.get('project', 'query') == [{'foo': 1}]
+        assert other_cache.hits == 1
+
+
 class TestUtilityFunc(object):
     # TODO
     pass